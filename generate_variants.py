@@ -1,11 +1,17 @@
 import asyncio
+import atexit
 import json
-import math
 import random
 import re
+from collections import OrderedDict
 from datetime import datetime
 import concurrent.futures
-from utils.inference import generate_text
+from utils.inference import generate_text_stream, generate_text_batch, get_session, close_session
+
+try:
+    import orjson  # Much faster C-level JSON encoding for large result files.
+except ImportError:
+    orjson = None
 
 # Global settings for variant generation
 MODEL = "deepseek-chat"
@@ -15,6 +21,8 @@ TIMEOUT_SECONDS = 1  # Maximum allowed seconds for any task if needed
 NUM_VARIANTS = 3          # Number of final variants per difficulty
 RECURSION_DEPTH = 0       # Set >0 if you want to generate variants recursively
 DIFFICULTIES = ["easier"] # Options could include "easier", "equivalent", "harder"
+VARIANTS_PER_CALL = 30    # Maximum number of variant blocks requested from a single LLM call
+BATCH_MODE = False        # Route chunks through the provider's Batch API (cheaper, but hours of latency)
 
 # Generic transformations by difficulty.
 # You can change these lists to suit different types of prompts.
@@ -52,91 +60,227 @@ PERSONAS = [
     "a pragmatic problem-solver"
 ]
 
-# This function returns a prompt template for the LLM.
-def get_random_prompt_template(prompt: str, difficulty: str, count: int, transforms_text: str, personas_str: str) -> str:
-    template_options = [
-        (
-            f"Assume you can adopt various personas such as {personas_str}.\n\n"
-            f"Given the prompt/task: {prompt}\n"
-            f"Your task is to generate {count} creative variant(s) that are {difficulty} than the original.\n\n"
-            "Important constraints:\n"
-            "- Maintain the original intent of the prompt.\n"
-            "- Avoid introducing arbitrary or irrelevant changes.\n"
-            "- All modifications should be specific and meaningful.\n\n"
-            "Follow these steps:\n"
-            "1. Analyze the original prompt deeply, looking for hidden simplifications and opportunities for improvement.\n"
-            "2. Think outside conventional approaches – consider alternative phrasings, simplifications, or restructuring.\n"
-            f"3. Draw inspiration from various fields. Some ideas: {transforms_text}\n"
-            "4. Provide a detailed explanation of your creative reasoning process.\n"
-            "5. Present each variant in the following exact format:\n"
-            "====\n"
-            "Variant <number>:\n"
-            "Reasoning: <your creative chain-of-thought explanation>\n"
-            "Variant: <the new prompt variant>\n"
-            "====\n\n"
-            "Generate truly novel variants that might surprise even experienced practitioners."
-        ),
-        (
-            f"Channel the creative spirit of professionals like {personas_str}.\n\n"
-            f"For this task: {prompt}\n"
-            f"Create {count} variant(s) that are {difficulty} than the original prompt.\n\n"
-            "Key points:\n"
-            "- Do not change the core intent of the prompt.\n"
-            "- All modifications must be specific and justified.\n\n"
-            "Steps:\n"
-            "1. Examine the prompt carefully and identify aspects that can be simplified or modified.\n"
-            f"2. Experiment with ideas such as: {transforms_text}\n"
-            "3. Explain your reasoning in detail.\n"
-            "4. Provide your answer in the following exact format:\n"
-            "====\n"
-            "Variant <number>:\n"
-            "Reasoning: <your creative chain-of-thought explanation>\n"
-            "Variant: <the new prompt variant>\n"
-            "====\n\n"
-            "Aim to create variants that reveal new perspectives on the original prompt."
-        )
-    ]
-    return random.choice(template_options)
+# Invariants hoisted out of the per-chunk path: the personas string never
+# changes, and the transformation pools are normalized to lowercase keys and
+# tuples once at import time.
+_PERSONAS_STR = ", ".join(PERSONAS)
+_TRANSFORMS = {k.lower(): tuple(v) for k, v in TRANSFORMATIONS_BY_DIFFICULTY.items()}
+
+# Module-local RNG: avoids the shared global random state and gives a single
+# place to seed for reproducible runs (e.g. _RNG.seed(0)).
+_RNG = random.Random()
+
+# One shared worker pool for blocking work such as result-file writes, so it
+# overlaps with event-loop I/O instead of stalling it.
+_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+atexit.register(_POOL.shutdown)
+
+# This function describes how many variants to produce per difficulty, e.g.
+# "10 variant(s) that are easier and 5 variant(s) that are harder".
+def describe_difficulty_request(difficulty_counts: dict) -> str:
+    parts = [f"{count} variant(s) that are {difficulty}" for difficulty, count in difficulty_counts.items()]
+    return " and ".join(parts)
+
+# The two prompt templates as builder functions so that only the randomly
+# chosen one is materialized per call, instead of constructing both ~1KB
+# strings and discarding one.
+def _build_template_a(prompt: str, request_text: str, total_count: int, difficulty_line: str,
+                      transforms_text: str, personas_str: str) -> str:
+    return (
+        f"Assume you can adopt various personas such as {personas_str}.\n\n"
+        f"Given the prompt/task: {prompt}\n"
+        f"Your task is to generate {request_text} than the original ({total_count} variant(s) in total).\n\n"
+        "Important constraints:\n"
+        "- Maintain the original intent of the prompt.\n"
+        "- Avoid introducing arbitrary or irrelevant changes.\n"
+        "- All modifications should be specific and meaningful.\n\n"
+        "Follow these steps:\n"
+        "1. Analyze the original prompt deeply, looking for hidden simplifications and opportunities for improvement.\n"
+        "2. Think outside conventional approaches – consider alternative phrasings, simplifications, or restructuring.\n"
+        f"3. Draw inspiration from various fields. Some ideas: {transforms_text}\n"
+        "4. Provide a detailed explanation of your creative reasoning process.\n"
+        f"5. Present each of the {total_count} variants in the following exact format:\n"
+        "====\n"
+        "Variant <number>:\n"
+        f"{difficulty_line}"
+        "Reasoning: <your creative chain-of-thought explanation>\n"
+        "Variant: <the new prompt variant>\n"
+        "====\n\n"
+        "Generate truly novel variants that might surprise even experienced practitioners."
+    )
+
+def _build_template_b(prompt: str, request_text: str, total_count: int, difficulty_line: str,
+                      transforms_text: str, personas_str: str) -> str:
+    return (
+        f"Channel the creative spirit of professionals like {personas_str}.\n\n"
+        f"For this task: {prompt}\n"
+        f"Create {request_text} than the original prompt ({total_count} variant(s) in total).\n\n"
+        "Key points:\n"
+        "- Do not change the core intent of the prompt.\n"
+        "- All modifications must be specific and justified.\n\n"
+        "Steps:\n"
+        "1. Examine the prompt carefully and identify aspects that can be simplified or modified.\n"
+        f"2. Experiment with ideas such as: {transforms_text}\n"
+        "3. Explain your reasoning in detail.\n"
+        f"4. Provide each of the {total_count} answers in the following exact format:\n"
+        "====\n"
+        "Variant <number>:\n"
+        f"{difficulty_line}"
+        "Reasoning: <your creative chain-of-thought explanation>\n"
+        "Variant: <the new prompt variant>\n"
+        "====\n\n"
+        "Aim to create variants that reveal new perspectives on the original prompt."
+    )
+
+_TEMPLATE_FNS = (_build_template_a, _build_template_b)
+
+# This function returns a prompt template for the LLM. A single prompt can ask
+# for variants across several difficulties at once; in that case each output
+# block is tagged with its difficulty so the parser can route it.
+def get_random_prompt_template(prompt: str, difficulty_counts: dict, transforms_text: str, personas_str: str) -> str:
+    request_text = describe_difficulty_request(difficulty_counts)
+    total_count = sum(difficulty_counts.values())
+    difficulty_line = "Difficulty: <the requested difficulty of this variant>\n" if len(difficulty_counts) > 1 else ""
+    return _RNG.choice(_TEMPLATE_FNS)(prompt, request_text, total_count, difficulty_line, transforms_text, personas_str)
+
+# Parsing regexes, compiled once at import time since they run on every LLM
+# response. The block delimiter is used while streaming to detect completed
+# blocks; the pair regex captures the (optional) difficulty tag,
+# the reasoning, and the variant line of each block, replacing the previous
+# ====-split plus per-block line scans.
+_BLOCK_RE = re.compile(r"====\s*")
+_PAIR_RE = re.compile(
+    r"(?:Difficulty:\s*(?P<difficulty>\w+)\s*)?"
+    r"Reasoning:\s*(?P<reason>.*?)\s*Variant:\s*(?P<variant>.+?)(?:\n|$)",
+    re.DOTALL,
+)
 
-# This function parses the LLM response to extract variants.
+_WS_RE = re.compile(r"\s+")
+
+# Canonical form used for deduplication: trivial differences in case or
+# whitespace should not count as distinct variants.
+def _canon(s: str) -> str:
+    return _WS_RE.sub(" ", s.strip().lower())
+
+# This function parses the LLM response to extract variants. The "difficulty"
+# key is None when the block carried no tag.
 def parse_variants(text: str) -> list:
-    variants = []
-    blocks = re.split(r"====\s*", text)
-    for block in blocks:
-        if "Variant:" in block and "Reasoning:" in block:
-            reasoning_match = re.search(r"Reasoning:\s*(.*?)\s*Variant:", block, re.DOTALL)
-            reasoning_text = reasoning_match.group(1).strip() if reasoning_match else ""
-            
-            variant_expr = None
-            for line in block.splitlines():
-                if line.strip().startswith("Variant:"):
-                    variant_expr = line.strip()[len("Variant:"):].strip()
-                    break
-            if variant_expr:
-                variants.append({"reasoning": reasoning_text, "variant": variant_expr})
-    return variants
+    return [
+        {
+            "reasoning": m.group("reason").strip(),
+            "variant": m.group("variant").strip(),
+            "difficulty": m.group("difficulty").lower() if m.group("difficulty") else None,
+        }
+        for m in _PAIR_RE.finditer(text)
+        if m.group("variant").strip()
+    ]
 
-# This function calls the LLM (via generate_text) to produce a chunk of variants.
-async def generate_variant_chunk(prompt: str, difficulty: str, count: int) -> list:
-    transformations = TRANSFORMATIONS_BY_DIFFICULTY.get(difficulty.lower(), ["make a small change"])
-    num_choices = random.choice(range(3, 7))
-    chosen_transforms = random.sample(transformations, min(num_choices, len(transformations)))
-    transforms_text = ", ".join(chosen_transforms)
-    personas_str = ", ".join(PERSONAS)
-    
-    prompt_variant = get_random_prompt_template(prompt, difficulty, count, transforms_text, personas_str)
-    temperature_choice = random.choice([0.8, 1.0, 1.2, 1.4])
-    response_text = await generate_text(MODEL, prompt_variant, temperature=temperature_choice)
-    
-    parsed_variants = parse_variants(response_text)
+# LRU cache of parsed chunk results. Recursive runs revisit the same
+# sub-prompt and repeated runs reuse identical base prompts; a cache hit
+# skips the LLM round trip entirely.
+_CHUNK_CACHE_MAX = 256
+_chunk_cache = OrderedDict()
+
+# This function samples the transformation inspirations for each difficulty.
+def _sample_transforms(difficulties) -> tuple:
+    transforms_by_difficulty = {}
+    for difficulty in difficulties:
+        transformations = _TRANSFORMS.get(difficulty.lower(), ("make a small change",))
+        num_choices = _RNG.randrange(3, 7)
+        transforms_by_difficulty[difficulty] = _RNG.sample(transformations, min(num_choices, len(transformations)))
+    transforms_text = ", ".join(t for transforms in transforms_by_difficulty.values() for t in transforms)
+    return transforms_by_difficulty, transforms_text
+
+# This function builds the chunk's LLM prompt. Callers scheduling many chunks
+# for one prompt pass pre-sampled transforms so each chunk only picks a
+# template and interpolates its counts.
+def _prepare_chunk(prompt: str, difficulty_counts: dict, transforms: tuple = None):
+    if transforms is None:
+        transforms = _sample_transforms(difficulty_counts)
+    transforms_by_difficulty, transforms_text = transforms
+
+    prompt_variant = get_random_prompt_template(prompt, difficulty_counts, transforms_text, _PERSONAS_STR)
+    temperature_choice = _RNG.choice((0.8, 1.0, 1.2, 1.4))
+    return prompt_variant, transforms_by_difficulty, temperature_choice
+
+# This function routes parsed variants to their difficulty, attaches the
+# transformations used, and appends the processed dicts to result.
+def _finalize_parsed_variants(prompt: str, difficulty_counts: dict, transforms_by_difficulty: dict,
+                              parsed_variants: list, timestamp: str, result: list):
+    default_difficulty = next(iter(difficulty_counts))
     for variant in parsed_variants:
-        variant["transformations_used"] = chosen_transforms
-    tasks = [process_single_variant(prompt, difficulty, variant) for variant in parsed_variants]
-    processed_variants = await asyncio.gather(*tasks)
-    return [v for v in processed_variants if v is not None]
+        difficulty = variant.get("difficulty")
+        if difficulty not in difficulty_counts:
+            difficulty = default_difficulty
+        variant["difficulty"] = difficulty
+        variant["transformations_used"] = transforms_by_difficulty[difficulty]
+        processed = process_single_variant(prompt, difficulty, variant, timestamp)
+        if processed is not None:
+            result.append(processed)
+
+# This function calls the LLM (via generate_text) to produce a chunk of variants.
+# A chunk covers every requested difficulty in a single call, so one round trip
+# replaces the previous one-call-per-(difficulty, chunk) fan-out.
+async def generate_variant_chunk(prompt: str, difficulty_counts: dict, transforms: tuple = None,
+                                 session=None) -> list:
+    cache_key = (prompt, tuple(sorted(difficulty_counts.items())), MODEL)
+    cached = _chunk_cache.get(cache_key)
+    if cached is not None:
+        _chunk_cache.move_to_end(cache_key)
+        return [dict(v) for v in cached]
+
+    prompt_variant, transforms_by_difficulty, temperature_choice = _prepare_chunk(prompt, difficulty_counts, transforms)
+
+    timestamp = datetime.utcnow().isoformat() + "Z"  # One timestamp per chunk.
+    result = []
+
+    def handle_block(block: str):
+        _finalize_parsed_variants(prompt, difficulty_counts, transforms_by_difficulty,
+                                  parse_variants(block), timestamp, result)
+
+    # Consume the streamed response and parse each block as soon as its
+    # closing ==== delimiter arrives, rather than waiting for the full
+    # completion before starting any processing.
+    buffer = ""
+    async for delta in generate_text_stream(MODEL, prompt_variant, temperature=temperature_choice, session=session):
+        buffer += delta
+        while True:
+            delimiter = _BLOCK_RE.search(buffer)
+            if not delimiter:
+                break
+            block, buffer = buffer[:delimiter.start()], buffer[delimiter.end():]
+            handle_block(block)
+    handle_block(buffer)
+
+    # Store copies so callers can mutate their results without corrupting
+    # the cache.
+    _chunk_cache[cache_key] = [dict(v) for v in result]
+    if len(_chunk_cache) > _CHUNK_CACHE_MAX:
+        _chunk_cache.popitem(last=False)
+    return result
 
-# This function processes a single variant.
-async def process_single_variant(original_prompt: str, difficulty: str, variant_data: dict) -> dict:
+# This function runs all of a prompt's chunks through the provider's Batch API
+# in a single submission instead of individual streaming calls. Used for
+# offline runs (BATCH_MODE) where cost matters more than latency.
+async def generate_variant_chunks_batched(prompt: str, chunk_counts: list, transforms: tuple = None,
+                                          session=None) -> list:
+    prepared = [_prepare_chunk(prompt, difficulty_counts, transforms) for difficulty_counts in chunk_counts]
+    requests = [
+        {"model": MODEL, "prompt": prompt_variant, "temperature": temperature_choice}
+        for prompt_variant, _, temperature_choice in prepared
+    ]
+    responses = await generate_text_batch(requests, session=session)
+
+    timestamp = datetime.utcnow().isoformat() + "Z"
+    result = []
+    for (_, transforms_by_difficulty, _), difficulty_counts, response_text in zip(prepared, chunk_counts, responses):
+        _finalize_parsed_variants(prompt, difficulty_counts, transforms_by_difficulty,
+                                  parse_variants(response_text), timestamp, result)
+    return result
+
+# This function processes a single variant. It does no I/O, so it is a plain
+# function rather than a coroutine.
+def process_single_variant(original_prompt: str, difficulty: str, variant_data: dict, timestamp: str) -> dict:
     variant_prompt = variant_data.get("variant")
     if not variant_prompt:
         return None
@@ -147,54 +291,107 @@ async def process_single_variant(original_prompt: str, difficulty: str, variant_
         "reasoning": variant_data.get("reasoning"),
         "transformations_used": variant_data.get("transformations_used", []),
         "evaluation": None,  # Placeholder for any evaluation metric if needed
-        "timestamp": datetime.utcnow().isoformat() + "Z"
+        "timestamp": timestamp
     }
 
 # This function orchestrates the variant generation for a given prompt.
-async def process_prompt(base_prompt: str, difficulties: list, num_variants: int = NUM_VARIANTS, recursion_depth: int = RECURSION_DEPTH) -> list:
+async def process_prompt(base_prompt: str, difficulties: list, num_variants: int = NUM_VARIANTS,
+                         recursion_depth: int = RECURSION_DEPTH, session=None) -> list:
     final_results = []
-    seen_variants = set()
+    # Dedup map of canonical key -> first-seen variant; counts enforce the
+    # per-difficulty quota during insertion so no post-filter slice is needed.
+    seen_variants = {}
+    counts = {d: 0 for d in difficulties}
     buffer_multiplier = 3  # Request extra variants to allow for filtering
-    tasks = []
+    futures = []
 
-    for difficulty in difficulties:
-        total_to_request = num_variants * buffer_multiplier
-        num_chunks = math.ceil(total_to_request / 10)
-        for i in range(num_chunks):
-            count = 10 if (i < num_chunks - 1) else (total_to_request - 10 * (num_chunks - 1))
-            tasks.append((difficulty, generate_variant_chunk(base_prompt, difficulty, count)))
+    # Each chunk asks for variants across all difficulties at once, so the
+    # number of LLM calls is ceil(total / VARIANTS_PER_CALL) rather than
+    # num_chunks * len(difficulties).
+    total_to_request = num_variants * buffer_multiplier  # per difficulty
+    full, rem = divmod(total_to_request, VARIANTS_PER_CALL)
+    sizes = [VARIANTS_PER_CALL] * full + ([rem] if rem else [])
+    chunk_counts = [{d: count for d in difficulties} for count in sizes]
+
+    # Sample the transformation text once for all chunks of this prompt;
+    # each chunk then only picks a template and interpolates its counts.
+    transforms = _sample_transforms(difficulties)
 
-    chunk_results = await asyncio.gather(*[t[1] for t in tasks])
+    if BATCH_MODE:
+        # One Batch API submission covers every chunk; the single future
+        # resolves to all chunk variants at once.
+        futures.append(asyncio.ensure_future(generate_variant_chunks_batched(base_prompt, chunk_counts, transforms, session)))
+    else:
+        for difficulty_counts in chunk_counts:
+            futures.append(asyncio.ensure_future(generate_variant_chunk(base_prompt, difficulty_counts, transforms, session)))
+
+    # Consume chunks as they finish; thanks to the buffer multiplier the
+    # unique-variant quota is often met before every chunk returns, so cancel
+    # whatever is still in flight once each difficulty is satisfied.
     difficulty_dict = {d: [] for d in difficulties}
-    for idx, (difficulty, _) in enumerate(tasks):
-        for variant in chunk_results[idx]:
+    for completed in asyncio.as_completed(futures):
+        chunk = await completed
+        for variant in chunk:
+            difficulty = variant.get("requested_difficulty")
+            if difficulty not in difficulty_dict or counts[difficulty] >= num_variants:
+                continue
             variant_expr = variant.get("variant")
-            if variant_expr and variant_expr not in seen_variants:
-                seen_variants.add(variant_expr)
+            if not variant_expr:
+                continue
+            # setdefault plus a length check needs a single hash lookup,
+            # versus the two of a membership test followed by an insert.
+            before = len(seen_variants)
+            seen_variants.setdefault(_canon(variant_expr), variant)
+            if len(seen_variants) != before:
                 difficulty_dict[difficulty].append(variant)
+                counts[difficulty] += 1
+        if all(counts[d] >= num_variants for d in difficulties):
+            for future in futures:
+                future.cancel()
+            break
 
     for difficulty in difficulties:
-        final_results.extend(difficulty_dict[difficulty][:num_variants])
-    
-    # If recursion is enabled, recursively generate variants of the variants.
-    if recursion_depth > 0:
-        recursive_results = []
-        for variant in final_results:
-            new_prompt = variant["variant"]
-            sub_variants = await process_prompt(new_prompt, difficulties, num_variants, recursion_depth - 1)
-            recursive_results.extend(sub_variants)
-        final_results.extend(recursive_results)
+        final_results.extend(difficulty_dict[difficulty])
     
+    # If recursion is enabled, generate variants of the variants level by
+    # level. Fanning out across all nodes of a level with gather replaces the
+    # old per-variant await loop, which processed sub-trees serially.
+    current_level = final_results
+    for _ in range(recursion_depth):
+        if not current_level:
+            break
+        sub_tasks = [process_prompt(v["variant"], difficulties, num_variants, 0, session) for v in current_level]
+        level_results = await asyncio.gather(*sub_tasks)
+        next_level = [v for sub_variants in level_results for v in sub_variants]
+        final_results.extend(next_level)
+        current_level = next_level
+
     return final_results
 
+# This function writes the variants file; it runs in the shared pool so the
+# (blocking) serialization and disk write stay off the event loop.
+def _write_variants(variants: list, filename: str):
+    if orjson is not None:
+        with open(filename, "wb") as outfile:
+            outfile.write(orjson.dumps(variants, option=orjson.OPT_INDENT_2))
+    else:
+        with open(filename, "w") as outfile:
+            json.dump(variants, outfile, indent=2)
+
 # Main entry point: you can change the base prompt, difficulties, or recursion depth here.
 async def main():
     base_prompt = "Describe how to optimize a robotics task for efficiency."
     difficulties = ["easier"]  # Change or add difficulties such as "equivalent" or "harder" if desired
-    variants = await process_prompt(base_prompt, difficulties, num_variants=NUM_VARIANTS, recursion_depth=RECURSION_DEPTH)
+    # Open the connection pool once up front so every chunk call, including
+    # those issued by deeper recursion levels, reuses the same warm pool.
+    session = get_session()
+    try:
+        variants = await process_prompt(base_prompt, difficulties, num_variants=NUM_VARIANTS,
+                                        recursion_depth=RECURSION_DEPTH, session=session)
+    finally:
+        await close_session()  # Release the shared connection pool.
     
-    with open("variants.json", "w") as outfile:
-        json.dump(variants, outfile, indent=2)
+    await asyncio.get_running_loop().run_in_executor(_POOL, _write_variants, variants, "variants.json")
     
     for idx, v in enumerate(variants, start=1):
         print(f"\n--- Variant {idx} ---")
@@ -0,0 +1,235 @@
+"""
+inference.py
+
+Thin async wrapper around OpenAI-compatible chat-completion endpoints
+(OpenAI, DeepSeek, ...). All callers go through generate_text(), which reuses
+a single module-level aiohttp.ClientSession so every concurrent request in an
+asyncio.gather shares one keep-alive connection pool instead of paying TLS/TCP
+setup per call.
+"""
+
+import asyncio
+import atexit
+import json
+import os
+
+import aiohttp
+
+# ---------------- Configuration ----------------
+REQUEST_TIMEOUT_SECONDS = 300  # Per-request timeout for LLM calls.
+MAX_CONCURRENCY = 32           # Maximum in-flight requests at any moment.
+QPM = 600                      # Sustained queries-per-minute budget.
+BATCH_POLL_SECONDS = 30        # How often to poll a submitted batch job.
+
+# Base URLs and API-key environment variables per provider. Models are routed
+# by prefix; anything unrecognized falls back to OpenAI.
+_PROVIDERS = {
+    "deepseek": ("https://api.deepseek.com/v1", "DEEPSEEK_API_KEY"),
+    "openai": ("https://api.openai.com/v1", "OPENAI_API_KEY"),
+}
+
+# Shared connection pool, created lazily on first use.
+_session = None
+
+# Rate limiting: a semaphore caps concurrent requests and a token bucket
+# (an asyncio.Queue refilled by a background task at QPM/60 Hz) paces them.
+# Both are created lazily so they bind to the running event loop.
+_sem = None
+_bucket = None
+_refill_task = None
+
+
+async def _refill_bucket():
+    while True:
+        try:
+            _bucket.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+        await asyncio.sleep(60.0 / QPM)
+
+
+def _get_rate_limiter():
+    global _sem, _bucket, _refill_task
+    if _sem is None:
+        _sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        _bucket = asyncio.Queue(maxsize=MAX_CONCURRENCY)
+        _refill_task = asyncio.get_running_loop().create_task(_refill_bucket())
+    return _sem, _bucket
+
+
+def _resolve_provider(model: str):
+    """Return (base_url, api_key) for the given model name."""
+    provider = "deepseek" if model.startswith("deepseek") else "openai"
+    base_url, key_var = _PROVIDERS[provider]
+    api_key = os.environ.get(key_var)
+    if not api_key:
+        raise RuntimeError(f"Missing API key: set the {key_var} environment variable.")
+    return base_url, api_key
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Return the shared ClientSession, creating it on first use."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=64, limit_per_host=32, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS),
+        )
+    return _session
+
+
+async def close_session():
+    """Close the shared session (call from main()'s finally block)."""
+    global _session, _sem, _bucket, _refill_task
+    if _refill_task is not None:
+        _refill_task.cancel()
+    _sem = _bucket = _refill_task = None
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _close_session_at_exit():
+    if _session is not None and not _session.closed:
+        try:
+            asyncio.run(close_session())
+        except RuntimeError:
+            pass  # Event loop already torn down; nothing left to do.
+
+
+atexit.register(_close_session_at_exit)
+
+
+async def generate_text(model: str, prompt: str, temperature: float = 0.7,
+                        session: aiohttp.ClientSession = None) -> str:
+    """
+    Send a single chat-completion request and return the response text.
+
+    Uses the shared module-level session unless an explicit session is passed.
+    """
+    base_url, api_key = _resolve_provider(model)
+    if session is None:
+        session = get_session()
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": temperature,
+    }
+    headers = {"Authorization": f"Bearer {api_key}"}
+    sem, bucket = _get_rate_limiter()
+    async with sem:
+        await bucket.get()
+        async with session.post(f"{base_url}/chat/completions", json=payload, headers=headers) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+    return data["choices"][0]["message"]["content"]
+
+
+async def generate_text_stream(model: str, prompt: str, temperature: float = 0.7,
+                               session: aiohttp.ClientSession = None):
+    """
+    Async generator yielding response text incrementally as the provider
+    streams it, so callers can start parsing before the full completion
+    arrives. Same routing/rate limiting as generate_text.
+    """
+    base_url, api_key = _resolve_provider(model)
+    if session is None:
+        session = get_session()
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": temperature,
+        "stream": True,
+    }
+    headers = {"Authorization": f"Bearer {api_key}"}
+    sem, bucket = _get_rate_limiter()
+    async with sem:
+        await bucket.get()
+        async with session.post(f"{base_url}/chat/completions", json=payload, headers=headers) as resp:
+            resp.raise_for_status()
+            async for raw_line in resp.content:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+
+async def generate_text_batch(requests: list, poll_interval: float = BATCH_POLL_SECONDS,
+                              session: aiohttp.ClientSession = None) -> list:
+    """
+    Run many chat-completion requests through the provider's Batch API
+    (OpenAI-style /files + /batches endpoints).
+
+    requests is a list of {"model", "prompt", "temperature"} dicts; the
+    response texts come back in the same order (empty string for requests the
+    provider could not answer). Batching trades latency for ~50% cost and
+    bulk throughput, so it suits offline generation runs. All requests in one
+    call must target the same provider.
+    """
+    model = requests[0]["model"]
+    base_url, api_key = _resolve_provider(model)
+    if session is None:
+        session = get_session()
+    headers = {"Authorization": f"Bearer {api_key}"}
+
+    lines = []
+    for i, request in enumerate(requests):
+        body = {
+            "model": request["model"],
+            "messages": [{"role": "user", "content": request["prompt"]}],
+            "temperature": request.get("temperature", 0.7),
+        }
+        lines.append(json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body,
+        }))
+
+    form = aiohttp.FormData()
+    form.add_field("purpose", "batch")
+    form.add_field("file", "\n".join(lines).encode("utf-8"),
+                   filename="batch_input.jsonl", content_type="application/jsonl")
+    async with session.post(f"{base_url}/files", data=form, headers=headers) as resp:
+        resp.raise_for_status()
+        input_file_id = (await resp.json())["id"]
+
+    batch_request = {
+        "input_file_id": input_file_id,
+        "endpoint": "/v1/chat/completions",
+        "completion_window": "24h",
+    }
+    async with session.post(f"{base_url}/batches", json=batch_request, headers=headers) as resp:
+        resp.raise_for_status()
+        batch_id = (await resp.json())["id"]
+
+    while True:
+        await asyncio.sleep(poll_interval)
+        async with session.get(f"{base_url}/batches/{batch_id}", headers=headers) as resp:
+            resp.raise_for_status()
+            batch = await resp.json()
+        status = batch["status"]
+        if status == "completed":
+            break
+        if status in ("failed", "expired", "cancelled"):
+            raise RuntimeError(f"Batch {batch_id} ended with status '{status}'.")
+
+    async with session.get(f"{base_url}/files/{batch['output_file_id']}/content", headers=headers) as resp:
+        resp.raise_for_status()
+        content = await resp.text()
+
+    responses = [""] * len(requests)
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        body = (record.get("response") or {}).get("body") or {}
+        choices = body.get("choices") or []
+        if choices:
+            responses[int(record["custom_id"])] = choices[0]["message"]["content"]
+    return responses